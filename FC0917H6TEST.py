@@ -23,17 +23,193 @@ import serial
 import time
 import logging
 import threading
+import mmap
+import os
+import struct
+import queue
+import asyncio
+import json
+from collections import deque, namedtuple
 from enum import Enum
 
-# 日誌設定
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('hopper_control.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# 日誌設定 (於 main() 呼叫；被其他程序 import 讀取狀態快照時不建立日誌檔)
+def setup_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('hopper_control.log', encoding='utf-8'),
+            logging.StreamHandler()
+        ]
+    )
+
+# 會讓馬達出幣的指令：送出後不得再因期限拋出例外，否則呼叫端會誤判失敗而重複退幣
+PAYOUT_COMMANDS = (0x35, 0x20)
+
+class HopperTimeoutError(TimeoutError):
+    """整體期限 (deadline) 已用盡時拋出，stage 為用盡時所在的步驟"""
+
+    def __init__(self, stage, budget=None):
+        self.stage = stage
+        self.budget = budget
+        if budget is None:
+            super().__init__(f"操作逾時: {stage}")
+        else:
+            super().__init__(f"操作逾時: {stage} (總期限 {budget:.2f} 秒已用盡)")
+
+class Deadline:
+    """
+    多步驟操作的整體期限。
+    一個公開操作建立一次 Deadline，之後傳給所有子指令與重試共用，
+    每一步的等待時間都會被裁切為 min(該步預設逾時, 剩餘時間)。
+    """
+
+    def __init__(self, seconds):
+        self.budget = float(seconds)
+        self.expires_at = time.monotonic() + self.budget
+
+    @classmethod
+    def coerce(cls, value):
+        """None -> None (不限時，沿用舊行為)；數字 -> 新 Deadline；Deadline -> 原物件"""
+        if value is None or isinstance(value, Deadline):
+            return value
+        return cls(value)
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, stage):
+        if self.expired():
+            raise HopperTimeoutError(stage, self.budget)
+
+    def cap(self, seconds, stage):
+        """檢查期限並回傳本步可用的等待時間"""
+        self.check(stage)
+        return min(seconds, self.remaining())
+
+# 13H 狀態類型中表示正在退幣的值 (多航道 0x20、智能 0x35)，快照與事件共用
+PAYOUT_STATUS_TYPES = (0x20, 0x35)
+# 13H 狀態類型：清空中
+EMPTYING_STATUS_TYPE = 0x19
+
+# ---------- 共享記憶體狀態快照 (供 UI / 看門狗 / 遙測等本機程序讀取) ----------
+# 固定佈局 (little-endian):
+#   Header : magic(4s) version(H) reserved(H) seq(I)
+#   Payload: updated_at(d) address(B) status_type(B) error_code(B) opto_status(B) flags(B) pad(3x)
+#            paid(I) remain(I) text(128s, UTF-8, 以 0 補齊)
+# seq 為 seqlock 計數器：寫入前 +1 (奇數=寫入中)，寫完再 +1 (偶數=穩定)，
+# 讀取端前後兩次讀到相同的偶數 seq 才採用該份資料，因此不需任何鎖。
+SNAPSHOT_MAGIC = b'H6ST'
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('<4sHHI')
+_SNAPSHOT_PAYLOAD = struct.Struct('<dBBBBB3xII128s')
+_SNAPSHOT_SEQ_OFFSET = 8
+SNAPSHOT_SIZE = _SNAPSHOT_HEADER.size + _SNAPSHOT_PAYLOAD.size
+
+SNAPSHOT_FLAG_ENABLED = 0x01
+SNAPSHOT_FLAG_OPTO_EMPTY = 0x02
+SNAPSHOT_FLAG_OPTO_FULL = 0x04
+SNAPSHOT_FLAG_OPTO_VALID = 0x08
+SNAPSHOT_FLAG_RESPONDING = 0x10
+SNAPSHOT_FLAG_PAYOUT_ACTIVE = 0x20
+SNAPSHOT_FLAG_EMPTYING = 0x40
+
+class StatusSnapshotWriter:
+    """由監控迴圈持有，將最新狀態寫入記憶體映射檔"""
+
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        try:
+            # 只擴大不縮小，避免正在映射此檔的讀取端失效
+            if os.fstat(fd).st_size < SNAPSHOT_SIZE:
+                os.ftruncate(fd, SNAPSHOT_SIZE)
+            self._mm = mmap.mmap(fd, SNAPSHOT_SIZE)
+        finally:
+            os.close(fd)
+        magic, version, _, seq = _SNAPSHOT_HEADER.unpack_from(self._mm, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            seq = 0
+        # 上次寫入途中中斷時 seq 可能停在奇數，校正回偶數
+        self._seq = seq + (seq & 1)
+        _SNAPSHOT_HEADER.pack_into(self._mm, 0, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, self._seq)
+
+    def publish(self, address, status_type=0, error_code=0, opto_status=0, flags=0, paid=0, remain=0, text=""):
+        payload = _SNAPSHOT_PAYLOAD.pack(
+            time.time(), address & 0xFF, status_type & 0xFF, error_code & 0xFF, opto_status & 0xFF,
+            flags & 0xFF, min(paid, 0xFFFFFFFF), min(remain, 0xFFFFFFFF),
+            text.encode('utf-8')[:128]
+        )
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        struct.pack_into('<I', self._mm, _SNAPSHOT_SEQ_OFFSET, self._seq)
+        self._mm[_SNAPSHOT_HEADER.size:SNAPSHOT_SIZE] = payload
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        struct.pack_into('<I', self._mm, _SNAPSHOT_SEQ_OFFSET, self._seq)
+
+    def close(self):
+        self._mm.close()
+
+class StatusSnapshotReader:
+    """唯讀映射狀態快照檔，read() 不經 ccTalk 匯流排、不加鎖"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), SNAPSHOT_SIZE, access=mmap.ACCESS_READ)
+
+    def read(self, max_retries=100):
+        """
+        回傳最新一份一致的快照 dict；尚未有任何發佈時回傳 None。
+        寫入端持續寫入導致 max_retries 次都讀不到一致資料時拋出 RuntimeError。
+        """
+        for _ in range(max_retries):
+            magic, version, _, seq1 = _SNAPSHOT_HEADER.unpack_from(self._mm, 0)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                return None
+            if seq1 & 1:
+                time.sleep(0)
+                continue
+            raw = self._mm[_SNAPSHOT_HEADER.size:SNAPSHOT_SIZE]
+            seq2 = struct.unpack_from('<I', self._mm, _SNAPSHOT_SEQ_OFFSET)[0]
+            if seq1 != seq2:
+                continue
+            if seq1 == 0:
+                return None
+            (updated_at, address, status_type, error_code, opto_status,
+             flags, paid, remain, text) = _SNAPSHOT_PAYLOAD.unpack(raw)
+            return {
+                "seq": seq1,
+                "updated_at": updated_at,
+                "address": address,
+                "status_type": status_type,
+                "error_code": error_code,
+                "opto_status": opto_status,
+                "enabled": bool(flags & SNAPSHOT_FLAG_ENABLED),
+                "opto_empty": bool(flags & SNAPSHOT_FLAG_OPTO_EMPTY),
+                "opto_full": bool(flags & SNAPSHOT_FLAG_OPTO_FULL),
+                "opto_valid": bool(flags & SNAPSHOT_FLAG_OPTO_VALID),
+                "responding": bool(flags & SNAPSHOT_FLAG_RESPONDING),
+                "payout_active": bool(flags & SNAPSHOT_FLAG_PAYOUT_ACTIVE),
+                "emptying": bool(flags & SNAPSHOT_FLAG_EMPTYING),
+                "paid": paid,
+                "remain": remain,
+                "text": text.rstrip(b'\x00').decode('utf-8', errors='ignore'),
+            }
+        raise RuntimeError("狀態快照持續更新中，無法取得一致資料")
+
+    def close(self):
+        self._mm.close()
+
+def read_status_snapshot(path='hopper_status.bin'):
+    """一次性讀取狀態快照 (其他程序使用)"""
+    reader = StatusSnapshotReader(path)
+    try:
+        return reader.read()
+    finally:
+        reader.close()
 
 class HopperMode(Enum):
     INTELLIGENT = "智能退幣"
@@ -41,6 +217,261 @@ class HopperMode(Enum):
     STATUS_CHECK = "狀態檢查"
     AUTO_RUN = "自動運行"
 
+# 校準時探測的指令 (皆為唯讀、不會讓馬達運轉)。
+# 只有這些指令會縮短讀取逾時；退幣、啟用、停止、取消等指令一律使用保守預設值，
+# 避免 ACK 稍晚到達就被誤判為無響應而讓操作員重複退幣。
+CALIBRATION_OPCODES = (0xFE, 0xF2, 0x13, 0xEC, 0xA3, 0x23)
+
+class LinkTimingProfile:
+    """
+    單一設備的通訊時序量測 (依指令碼分別記錄，僅限 CALIBRATION_OPCODES)。
+    每筆樣本為 (送出後到收齊回覆的秒數, 回覆中最大的字節間隔)，
+    以最近 window 筆的最大值乘上 margin 推得該指令的讀取逾時與兩幀之間的間隔。
+    樣本不足或被標記為 stale (校準後的逾時開始失效) 時一律退回呼叫端給的保守預設值。
+    """
+
+    def __init__(self, margin=1.5, min_read_timeout=0.2, default_frame_gap=0.05,
+                 min_frame_gap=0.002, window=32, min_samples=3, recalibrate_after=3):
+        self.margin = margin
+        self.min_read_timeout = min_read_timeout
+        self.default_frame_gap = default_frame_gap
+        self.min_frame_gap = min_frame_gap
+        self.window = window
+        self.min_samples = min_samples
+        self.recalibrate_after = recalibrate_after
+        self.samples = {}
+        self.stale = False
+        self.consecutive_timeouts = 0
+        self.calibrated_at = None
+        self._lock = threading.Lock()
+
+    def record(self, opcode, reply_s, gap_s):
+        if opcode not in CALIBRATION_OPCODES:
+            return
+        with self._lock:
+            self.samples.setdefault(opcode, deque(maxlen=self.window)).append((reply_s, gap_s))
+            self.consecutive_timeouts = 0
+
+    def record_timeout(self, opcode):
+        """只有在使用校準值時逾時才計數，連續 recalibrate_after 次即標記需要重新校準"""
+        if not self.is_calibrated(opcode):
+            return
+        with self._lock:
+            self.consecutive_timeouts += 1
+            if self.consecutive_timeouts >= self.recalibrate_after and not self.stale:
+                self.stale = True
+                logging.warning(f"連續 {self.consecutive_timeouts} 次逾時，通訊時序需要重新校準")
+
+    def is_calibrated(self, opcode):
+        return (opcode in CALIBRATION_OPCODES and not self.stale
+                and len(self.samples.get(opcode, ())) >= self.min_samples)
+
+    def is_fresh(self, max_age_s):
+        """是否有 max_age_s 秒內、且每個校準指令樣本都足夠的量測 (可免重新探測)"""
+        if self.stale or not self.calibrated_at or time.time() - self.calibrated_at > max_age_s:
+            return False
+        return all(len(self.samples.get(opcode, ())) >= self.min_samples for opcode in CALIBRATION_OPCODES)
+
+    def read_timeout(self, opcode, fallback):
+        """校準後的讀取逾時，不會比 fallback 更寬鬆"""
+        if not self.is_calibrated(opcode):
+            return fallback
+        with self._lock:
+            worst = max(reply_s for reply_s, _ in self.samples[opcode])
+        return min(fallback, max(self.min_read_timeout, worst * self.margin))
+
+    def frame_gap(self):
+        """送出下一幀前距離上一次匯流排活動至少要間隔的秒數"""
+        with self._lock:
+            gaps = [gap_s for window in self.samples.values() for _, gap_s in window]
+        if self.stale or not gaps:
+            return self.default_frame_gap
+        return max(self.min_frame_gap, max(gaps) * self.margin)
+
+    def reset(self, opcodes):
+        with self._lock:
+            for opcode in opcodes:
+                self.samples.pop(opcode, None)
+
+    def mark_calibrated(self):
+        self.stale = False
+        self.consecutive_timeouts = 0
+        self.calibrated_at = time.time()
+
+    def summary(self, fallback):
+        return {
+            f"0x{opcode:02X}": round(self.read_timeout(opcode, fallback), 3)
+            for opcode in sorted(self.samples)
+        }
+
+    def to_dict(self):
+        with self._lock:
+            samples = {f"{opcode:02X}": [list(s) for s in window] for opcode, window in self.samples.items()}
+        return {"calibrated_at": self.calibrated_at, "samples": samples}
+
+    def load_dict(self, data):
+        with self._lock:
+            self.samples = {
+                int(opcode, 16): deque((tuple(s) for s in window), maxlen=self.window)
+                for opcode, window in data.get("samples", {}).items()
+                if int(opcode, 16) in CALIBRATION_OPCODES
+            }
+        self.calibrated_at = data.get("calibrated_at")
+        self.stale = False
+        self.consecutive_timeouts = 0
+
+class MotorDutyGovernor:
+    """
+    馬達負載 (熱量) 調節器，以「熱量桶」估算馬達溫度：
+    - 每次退幣依 啟動時間 + 硬幣數 x 每枚時間 估計馬達運轉秒數，先預扣到 heat；
+      退幣結束後由監控迴圈以實際觀測值 settle() 修正。
+    - heat 以 cooling_rate (每秒散去的運轉秒數) 持續下降，長期可持續負載比 = cooling_rate。
+    - heat + 本次預估 超過 thermal_capacity_s 時 acquire() 會等待冷卻 (排隊 / 限速)；
+      馬達冷卻時可一次爆發至整個容量；單次預估超過容量時只預扣至容量上限，
+      等退幣結束後再以實際運轉時間結算。
+    - 每次預扣回傳一個 token，退幣結束後以該 token settle()，多筆退幣互不影響。
+    - 連續 max_consecutive_failures 次缺幣 (退幣未完成) 後拒絕退幣，避免空轉過熱，
+      直到偵測到補幣或呼叫 reset_failures()。
+    """
+
+    def __init__(self, thermal_capacity_s=60.0, cooling_rate=0.3, startup_s=0.5,
+                 seconds_per_coin=0.25, max_consecutive_failures=3):
+        self.thermal_capacity_s = thermal_capacity_s
+        self.cooling_rate = cooling_rate
+        self.startup_s = startup_s
+        self.seconds_per_coin = seconds_per_coin
+        self.max_consecutive_failures = max_consecutive_failures
+        self.heat = 0.0
+        self.consecutive_failures = 0
+        # token -> 預扣的運轉秒數
+        self._reservations = {}
+        self._next_token = 1
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+        # 等待冷卻的退幣依序排隊
+        self._admission_lock = threading.Lock()
+
+    def estimate_run_seconds(self, coins):
+        return self.startup_s + max(0, coins) * self.seconds_per_coin
+
+    def _cool(self):
+        now = time.monotonic()
+        self.heat = max(0.0, self.heat - (now - self._updated_at) * self.cooling_rate)
+        self._updated_at = now
+
+    def headroom(self):
+        """目前還能立即運轉的馬達秒數"""
+        with self._lock:
+            self._cool()
+            return max(0.0, self.thermal_capacity_s - self.heat)
+
+    def wait_time(self, run_s):
+        """預估 run_s 秒的退幣需等待多久才能開始；cooling_rate 為 0 時無法冷卻，回傳 inf"""
+        with self._lock:
+            self._cool()
+            excess = self.heat + run_s - self.thermal_capacity_s
+            if excess <= 0:
+                return 0.0
+            if self.cooling_rate <= 0:
+                return float('inf')
+            return excess / self.cooling_rate
+
+    def is_locked_out(self):
+        return self.consecutive_failures >= self.max_consecutive_failures
+
+    def acquire(self, run_s, deadline=None, max_wait=5.0):
+        """
+        等待熱量餘裕後預扣 run_s 秒 (最多預扣至熱容量)，回傳供 settle() 使用的 token。
+        deadline 不足以等到冷卻時立即拋出 HopperTimeoutError (不空等)；
+        未給 deadline 時最多等 max_wait 秒，需要更久則不預扣、回傳 None。
+        """
+        run_s = min(run_s, self.thermal_capacity_s)
+        stage = "等待馬達冷卻"
+        if deadline is None:
+            self._admission_lock.acquire()
+        else:
+            deadline.check(stage)
+            if not self._admission_lock.acquire(timeout=deadline.remaining()):
+                raise HopperTimeoutError(stage, deadline.budget)
+        try:
+            while True:
+                wait = self.wait_time(run_s)
+                if wait <= 0:
+                    break
+                if deadline is not None and wait > deadline.remaining():
+                    raise HopperTimeoutError(f"{stage} (需 {wait:.1f} 秒)", deadline.budget)
+                if deadline is None and wait > max_wait:
+                    return None
+                logging.info(f"馬達熱量餘裕不足，等待冷卻 {wait:.1f} 秒")
+                time.sleep(wait)
+            with self._lock:
+                self._cool()
+                self.heat += run_s
+                token = self._next_token
+                self._next_token += 1
+                self._reservations[token] = run_s
+                return token
+        finally:
+            self._admission_lock.release()
+
+    def settle(self, token, actual_run_s=None):
+        """
+        以實際運轉秒數取代該 token 的預估；actual_run_s 為 None 表示無從得知，保留預估值。
+        token 不存在 (已 settle) 時忽略。
+        """
+        with self._lock:
+            reserved = self._reservations.pop(token, None)
+            if reserved is None or actual_run_s is None:
+                return
+            self._cool()
+            self.heat = max(0.0, self.heat + actual_run_s - reserved)
+
+    def add_run(self, run_s):
+        """計入非退幣指令造成的馬達運轉 (例如清空)"""
+        with self._lock:
+            self._cool()
+            self.heat += run_s
+
+    def record_success(self):
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+
+    def reset_failures(self):
+        self.consecutive_failures = 0
+
+    def report(self):
+        with self._lock:
+            self._cool()
+            heat = self.heat
+        return {
+            "heat_s": heat,
+            "headroom_s": max(0.0, self.thermal_capacity_s - heat),
+            "capacity_s": self.thermal_capacity_s,
+            "load": heat / self.thermal_capacity_s if self.thermal_capacity_s else 0.0,
+            "sustained_duty": self.cooling_rate,
+            "pending_payouts": len(self._reservations),
+            "consecutive_failures": self.consecutive_failures,
+            "locked_out": self.is_locked_out(),
+        }
+
+class HopperEventType(Enum):
+    STATUS_CHANGED = "狀態變更"
+    PAYOUT_STARTED = "開始退幣"
+    PAYOUT_PROGRESS = "退幣進度"
+    PAYOUT_DONE = "退幣完成"
+    COIN_SHORTAGE = "缺幣"
+    DEVICE_ERROR = "設備錯誤"
+    ERROR_CLEARED = "錯誤解除"
+    HOPPER_EMPTY = "料斗已空"
+    HOPPER_REFILLED = "料斗已補幣"
+    DEVICE_LOST = "設備無響應"
+    DEVICE_RESTORED = "設備恢復響應"
+
+# type: HopperEventType, timestamp: time.time(), data: dict (依事件類型而定)
+HopperEvent = namedtuple('HopperEvent', ['type', 'timestamp', 'data'])
+
 class HopperController:
 
     def __init__(self):
@@ -54,6 +485,39 @@ class HopperController:
         self.connection_tested = False
         self.is_enabled = False
         self.device_serial = None
+        # 未指定 timeout_override 時每次讀取回應的預設等待秒數
+        self.default_read_timeout = 2
+        # 監控迴圈維護的最新狀態 (見 decode_status)，以及可選的共享記憶體快照
+        self.live_state = {}
+        self.snapshot_writer = None
+        # 連線後自動發佈狀態快照的檔案路徑，設為 None 則不發佈
+        self.status_snapshot_path = 'hopper_status.bin'
+        # 事件訂閱：{訂閱編號: (callback, 事件類型集合或 None)}，由獨立執行緒派送
+        self._subscribers = {}
+        self._subscribers_lock = threading.Lock()
+        self._next_subscription_id = 1
+        self._event_queue = queue.Queue()
+        self._event_thread = None
+        # 馬達負載調節；智能退幣前以 金額 / payout_coin_value_hint 粗估硬幣數，結束後以實際值修正
+        self.motor_governor = MotorDutyGovernor()
+        self.payout_coin_value_hint = 5
+        # 由 23H 回報的 已付金額 / 硬幣枚數 學得的平均每枚面額，取代 payout_coin_value_hint
+        self.observed_value_per_coin = None
+        # 已被裝置接受、尚未結算的退幣 (依送出順序)：{"token", "command", "started"}
+        self._pending_payouts = deque()
+        self._pending_payouts_lock = threading.Lock()
+        # 送出超過此秒數、設備已閒置卻仍無法對應到 23H/13H 結果的退幣，以預估值結算 (不計入缺幣)
+        self.pending_payout_timeout = 60
+        self._emptying_observed_since = None
+        # 通訊時序校準：量測值依設備序列號存於 link_timing_path
+        self.link_timing = LinkTimingProfile()
+        self.link_timing_path = 'link_timing.json'
+        self.recalibrate_interval = 60
+        # 已存檔的量測在此秒數內視為有效，連線時不必重新探測
+        self.calibration_max_age = 24 * 3600
+        self._calibration_requested = False
+        self._last_calibration_attempt = None
+        self._last_bus_activity = 0.0
 
         # 安全閾值（可調）：若任一幣別吐出數量超過則視為異常 -> 自動 stop
         self.coin_count_threshold = 200
@@ -61,8 +525,8 @@ class HopperController:
         self.paid_multiplier_threshold = 5
 
     # 查詢上一命令狀態 (0x23)
-    def request_last_command_status(self):
-        resp = self.send_command(0x23, [], timeout_override=1)
+    def request_last_command_status(self, deadline=None):
+        resp = self.send_command(0x23, [], timeout_override=1, deadline=deadline)
         if not resp or len(resp) < 5:
             return "LAST CMD STATUS 無回應或數據不足"
 
@@ -91,7 +555,7 @@ class HopperController:
         ports = list_ports.comports()
         return [(p.device, p.description) for p in ports]
 
-    def connect(self, port_name=None):
+    def connect(self, port_name=None, deadline=None):
         if port_name is None:
             ports = self.find_serial_ports()
             if not ports:
@@ -112,24 +576,38 @@ class HopperController:
             )
             logging.info(f"已連接至 {port_name}")
 
-            ok = self.test_connection_with_diagnostics()
+            deadline = Deadline.coerce(deadline)
+            ok = self.test_connection_with_diagnostics(deadline=deadline)
             if ok:
-                self.get_serial_number()
-                self.enable_device()
+                # 換機或重連時不可沿用上一台設備的量測
+                self.link_timing = LinkTimingProfile()
+                if self.get_serial_number(deadline=deadline):
+                    self._load_link_timing()
+                # 校準不佔用呼叫端的連線期限：交給監控迴圈在啟用後的第一個閒置時段執行
+                self._calibration_requested = not self.link_timing.is_fresh(self.calibration_max_age)
+                self.enable_device(deadline=deadline)
+                if self.status_snapshot_path and not self.snapshot_writer:
+                    try:
+                        self.enable_status_snapshot(self.status_snapshot_path)
+                    except OSError as e:
+                        logging.error(f"狀態快照啟用失敗: {e}")
                 self.start_status_monitoring()
                 return True
             else:
                 logging.warning("通訊測試失敗，但保持連接以便診斷")
                 return True
 
+        except HopperTimeoutError:
+            raise
         except Exception as e:
             logging.error(f"連接失敗: {e}")
             return False
 
-    def enable_device(self):
+    def enable_device(self, deadline=None):
         if not self.ser or not self.ser.is_open:
             logging.error("串列埠未連接")
             return False
+        deadline = Deadline.coerce(deadline)
         cmd = [self.hopper_address, 0x01, 0x01, 0xA4, 0xA5]
         chk = self.calculate_checksum(cmd)
         cmd.append(chk)
@@ -138,8 +616,9 @@ class HopperController:
         except: pass
         try:
             logging.info(f"發送啟用指令: {bytes(cmd).hex('-').upper()}")
-            self.ser.write(bytes(cmd)); self.ser.flush(); time.sleep(0.2)
-            response = self.ser.read(8)
+            self._wait_frame_gap(deadline, "啟用設備 (A4H)")
+            self.ser.write(bytes(cmd)); self.ser.flush()
+            response = self._exchange_reply(0xA4, self.default_read_timeout, deadline, "啟用設備 (A4H)", max_bytes=8)
             if response and len(response) >= 4 and response[3] == 0x00:
                 self.is_enabled = True
                 logging.info("設備啟用成功")
@@ -147,16 +626,21 @@ class HopperController:
             else:
                 logging.warning("設備啟用失敗或無響應")
                 return False
+        except HopperTimeoutError:
+            raise
         except Exception as e:
             logging.error(f"啟用指令錯誤: {e}")
             return False
 
-    def disable_device(self):
+    def disable_device(self, deadline=None):
         if not self.ser or not self.ser.is_open:
             logging.error("串列埠未連接")
             return False
+        deadline = Deadline.coerce(deadline)
         cmd = [self.hopper_address, 0x01, 0x01, 0xA4, 0x00]
         cmd.append(self.calculate_checksum(cmd))
+        if deadline is not None:
+            deadline.check("禁用設備")
         try:
             self.ser.write(bytes(cmd)); self.ser.flush()
             self.is_enabled = False
@@ -166,16 +650,18 @@ class HopperController:
             logging.error(f"禁用指令錯誤: {e}")
             return False
 
-    def get_serial_number(self):
+    def get_serial_number(self, deadline=None):
         if not self.ser or not self.ser.is_open:
             logging.error("串列埠未連接")
             return False
+        deadline = Deadline.coerce(deadline)
         cmd = [self.hopper_address, 0x00, 0x01, 0xF2]
         cmd.append(self.calculate_checksum(cmd))
         try:
             self.ser.reset_input_buffer(); self.ser.reset_output_buffer()
-            self.ser.write(bytes(cmd)); self.ser.flush(); time.sleep(0.2)
-            response = self.ser.read(16)
+            self._wait_frame_gap(deadline, "讀取序列號 (F2H)")
+            self.ser.write(bytes(cmd)); self.ser.flush()
+            response = self._exchange_reply(0xF2, self.default_read_timeout, deadline, "讀取序列號 (F2H)", max_bytes=16)
             if response and len(response) >= 8:
                 serial_bytes = response[4:7]
                 self.device_serial = bytes(serial_bytes)
@@ -184,53 +670,218 @@ class HopperController:
             else:
                 logging.warning("獲取序列號失敗或回應不足")
                 return False
+        except HopperTimeoutError:
+            raise
         except Exception as e:
             logging.error(f"獲取序列號失敗: {e}")
             return False
 
-    def ensure_enabled(self):
+    def ensure_enabled(self, deadline=None):
         if not self.is_enabled:
             logging.info("設備未啟用，嘗試啟用...")
-            return self.enable_device()
+            return self.enable_device(deadline=deadline)
         return True
 
-    def send_command(self, command, data=None, timeout_override=None):
+    def _sleep(self, seconds, deadline, stage):
+        """受期限約束的 sleep：期限已用盡時拋出 HopperTimeoutError，否則最多睡到期限為止"""
+        if deadline is not None:
+            seconds = deadline.cap(seconds, stage)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    @staticmethod
+    def _reply_complete(buf):
+        """緩衝區開頭是否已是一個完整、發給主機 (0x01) 的 ccTalk 回覆"""
+        return len(buf) >= 5 and buf[0] == 0x01 and len(buf) >= buf[1] + 5
+
+    def _read_response(self, timeout, deadline=None, stage="讀取回應", max_bytes=256, timing=None):
+        """
+        以輪詢 in_waiting 的方式讀取回應，不修改 self.ser.timeout。
+        收到完整回覆即返回；否則等到 min(timeout, 期限剩餘) 為止，
+        若因期限用盡而一個字節都沒收到則拋出 HopperTimeoutError。
+        timing: 若提供 dict，收到完整回覆時填入 reply_s (送出後到收齊) 與 gap_s (最大字節間隔)。
+        """
+        if deadline is not None:
+            timeout = deadline.cap(timeout, stage)
+        start = time.monotonic()
+        end = start + max(0.0, timeout)
+        buf = bytearray()
+        last_arrival = None
+        max_gap = 0.0
+        while len(buf) < max_bytes:
+            waiting = self.ser.in_waiting
+            if waiting:
+                buf += self.ser.read(min(waiting, max_bytes - len(buf)))
+                now = time.monotonic()
+                if last_arrival is not None:
+                    max_gap = max(max_gap, now - last_arrival)
+                last_arrival = now
+                if self._reply_complete(buf):
+                    if timing is not None:
+                        timing["reply_s"] = now - start
+                        timing["gap_s"] = max_gap
+                    break
+                continue
+            if time.monotonic() >= end:
+                break
+            time.sleep(0.001)
+        if not buf and deadline is not None:
+            deadline.check(stage)
+        return bytes(buf)
+
+    def _wait_frame_gap(self, deadline, stage):
+        """送出前確保距離上一次匯流排活動已超過校準的幀間隔 (取代固定的 sleep)"""
+        idle = time.monotonic() - self._last_bus_activity
+        self._sleep(max(0.0, self.link_timing.frame_gap() - idle), deadline, stage)
+
+    def _exchange_reply(self, opcode, fallback_timeout, deadline, stage, max_bytes=256):
+        """以該指令校準後的逾時讀取回覆，並把量測到的時序回饋給 link_timing"""
+        timing = {}
+        timeout = self.link_timing.read_timeout(opcode, fallback_timeout)
+        try:
+            response = self._read_response(timeout, deadline, stage, max_bytes=max_bytes, timing=timing)
+        finally:
+            self._last_bus_activity = time.monotonic()
+        if timing:
+            self.link_timing.record(opcode, timing["reply_s"], timing["gap_s"])
+        elif not response:
+            self.link_timing.record_timeout(opcode)
+        return response
+
+    def send_command(self, command, data=None, timeout_override=None, deadline=None, retries=0):
+        """
+        發送 ccTalk 指令並讀取回應。
+        deadline: 整體期限 (秒數或 Deadline)，與呼叫端其他子指令共用；
+                  期限用盡時拋出 HopperTimeoutError，而非回傳 None。
+        retries:  無回應時的重試次數，剩餘期限平均分配給尚未進行的嘗試。
+        """
         if data is None:
             data = []
-        with self.thread_lock:
+        deadline = Deadline.coerce(deadline)
+        stage = f"指令 0x{command:02X}"
+        if deadline is None:
+            self.thread_lock.acquire()
+        else:
+            deadline.check(stage)
+            if not self.thread_lock.acquire(timeout=deadline.remaining()):
+                raise HopperTimeoutError(f"{stage} 等待串列埠", deadline.budget)
+        try:
             if not self.ser or not self.ser.is_open:
                 logging.error("串列埠未連接")
                 return None
-            if command in [0x35, 0x20, 0xA7] and not self.ensure_enabled():
+            if command in [0x35, 0x20, 0xA7] and not self.ensure_enabled(deadline=deadline):
                 logging.error("設備啟用失敗，無法發送支付指令")
                 return None
             data_len = len(data)
             cmd = [self.hopper_address, data_len, 0x01, command] + list(data)
             checksum = self.calculate_checksum(cmd)
             cmd.append(checksum)
-            try:
+            read_timeout = self.default_read_timeout if timeout_override is None else timeout_override
+            attempts = retries + 1
+            for attempt in range(attempts):
                 try:
-                    self.ser.reset_input_buffer(); self.ser.reset_output_buffer()
-                except: pass
-                logging.info(f"發送指令: {bytes(cmd).hex('-').upper()}")
-                self.ser.write(bytes(cmd)); self.ser.flush()
-                original_timeout = getattr(self.ser, 'timeout', None)
-                if timeout_override is not None:
-                    self.ser.timeout = timeout_override
-                # 等待與讀取
-                time.sleep(0.05 + 0.01 * data_len)
-                response = self.ser.read(256)
-                if timeout_override is not None and original_timeout is not None:
-                    self.ser.timeout = original_timeout
-                if response:
-                    logging.info(f"接收響應: {response.hex('-').upper()} (長度: {len(response)} 字節)")
-                    return response
-                else:
-                    logging.warning(f"指令 0x{command:02X} 無響應")
+                    try:
+                        self.ser.reset_input_buffer(); self.ser.reset_output_buffer()
+                    except: pass
+                    attempt_timeout = read_timeout
+                    if deadline is not None:
+                        # 剩餘期限平均分給尚未進行的嘗試
+                        attempt_timeout = min(read_timeout, deadline.cap(read_timeout, stage) / (attempts - attempt))
+                    logging.info(f"發送指令: {bytes(cmd).hex('-').upper()}")
+                    self._wait_frame_gap(deadline, stage)
+                    self.ser.write(bytes(cmd)); self.ser.flush()
+                    # 退幣指令已送出：只在剩餘期限內等 ACK，等不到就當作無回應，不拋出
+                    read_deadline = None if command in PAYOUT_COMMANDS else deadline
+                    response = self._exchange_reply(command, attempt_timeout, read_deadline, stage)
+                    if response:
+                        logging.info(f"接收響應: {response.hex('-').upper()} (長度: {len(response)} 字節)")
+                        return response
+                    logging.warning(f"指令 0x{command:02X} 無響應 (第 {attempt + 1}/{attempts} 次)")
+                except HopperTimeoutError:
+                    raise
+                except Exception as e:
+                    logging.error(f"通訊錯誤: {e}")
                     return None
-            except Exception as e:
-                logging.error(f"通訊錯誤: {e}")
-                return None
+            return None
+        finally:
+            self.thread_lock.release()
+
+    # ---------- 通訊時序校準 ----------
+    def calibrate_link(self, samples=5, deadline=None):
+        """
+        量測此設備各唯讀指令的回覆延遲與字節間隔，更新 link_timing 並存檔。
+        連線後若沒有近期的存檔量測，或校準值開始逾時，監控迴圈會在閒置時自動呼叫。
+        """
+        deadline = Deadline.coerce(deadline)
+        self._last_calibration_attempt = time.monotonic()
+        profile = self.link_timing
+        # 設備無回應就不浪費時間逐一量測，也不清掉既有的量測
+        if self.send_command(0xFE, [], 1, deadline=deadline) is None:
+            logging.warning("通訊時序校準: 設備無回應，保留現有時序")
+            return False
+        # 探測期間使用保守預設值
+        profile.reset(CALIBRATION_OPCODES)
+        for opcode in CALIBRATION_OPCODES:
+            for _ in range(samples):
+                self.send_command(opcode, [], deadline=deadline)
+        profile.mark_calibrated()
+        logging.info(f"通訊時序校準完成，各指令讀取逾時 (秒): {profile.summary(self.default_read_timeout)}, "
+                     f"幀間隔: {profile.frame_gap() * 1000:.1f} ms")
+        self._save_link_timing()
+        return True
+
+    def _load_link_timing(self):
+        if not self.device_serial:
+            return
+        try:
+            with open(self.link_timing_path, encoding='utf-8') as f:
+                stored = json.load(f).get(self.device_serial.hex().upper())
+            if not stored:
+                return
+            profile = LinkTimingProfile()
+            profile.load_dict(stored)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logging.warning(f"通訊時序校準資料無法讀取，將重新校準: {e}")
+            return
+        self.link_timing = profile
+        logging.info(f"已載入設備 {self.device_serial.hex('-').upper()} 的通訊時序校準資料")
+
+    def _save_link_timing(self):
+        if not self.device_serial:
+            return
+        try:
+            with open(self.link_timing_path, encoding='utf-8') as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            stored = {}
+        stored[self.device_serial.hex().upper()] = self.link_timing.to_dict()
+        try:
+            with open(self.link_timing_path, 'w', encoding='utf-8') as f:
+                json.dump(stored, f, indent=2)
+        except OSError as e:
+            logging.error(f"儲存通訊時序校準資料失敗: {e}")
+
+    def _recalibrate_if_needed(self):
+        """
+        監控迴圈在閒置時呼叫：連線時要求的首次校準立即執行；
+        校準值失效時則距上次嘗試超過 recalibrate_interval 才重新校準。
+        """
+        requested = self._calibration_requested
+        if not requested and not self.link_timing.stale:
+            return
+        if self.live_state.get("status_type") in PAYOUT_STATUS_TYPES:
+            return
+        last = self._last_calibration_attempt
+        if not requested and last is not None and time.monotonic() - last < self.recalibrate_interval:
+            return
+        self._calibration_requested = False
+        if requested:
+            logging.info("無近期的通訊時序量測，開始校準...")
+        else:
+            logging.info("偵測到校準後逾時，重新校準通訊時序...")
+        self.calibrate_link()
 
     def analyze_response(self, response, command):
         if not response:
@@ -334,8 +985,8 @@ class HopperController:
             return f"解析智能支付狀態失敗: {e}"
 
     # 停止支付 (STOP PAYMENT 0xAC)
-    def stop_payment(self):
-        resp = self.send_command(0xAC, [], timeout_override=1)
+    def stop_payment(self, deadline=None):
+        resp = self.send_command(0xAC, [], timeout_override=1, deadline=deadline)
         if resp and len(resp) >= 6:
             # 回應: [01][01][Add][00][Data1][Chk]
             left = resp[4]
@@ -346,8 +997,8 @@ class HopperController:
             return None
 
     # 取消 (CANCEL 0x15)
-    def cancel_current(self):
-        resp = self.send_command(0x15, [], timeout_override=1)
+    def cancel_current(self, deadline=None):
+        resp = self.send_command(0x15, [], timeout_override=1, deadline=deadline)
         if resp:
             logging.info("發出 CANCEL (0x15)。回應: %s", resp.hex('-').upper())
             return resp
@@ -356,11 +1007,17 @@ class HopperController:
             return None
 
     # 在發送智能退幣後立即檢查狀態，並在必要時自動停止
-    def intelligent_payout(self, amount):
-        """執行智能退幣（修正：支援 MSB-first / LSB-first 發送金額）"""
+    def intelligent_payout(self, amount, deadline=None):
+        """
+        執行智能退幣（修正：支援 MSB-first / LSB-first 發送金額）
+        deadline: 整體期限 (秒)，由取序列號、啟用、等待馬達冷卻、0x35、0x13 共用；
+                  只有在 0x35 送出之前用盡才拋出 HopperTimeoutError，
+                  送出後的狀態查詢逾時只會回報「無法取得即時狀態」，避免呼叫端重複退幣
+        """
+        deadline = Deadline.coerce(deadline)
         if not self.device_serial:
             logging.warning("未獲取到設備序列號，嘗試重新獲取...")
-            if not self.get_serial_number():
+            if not self.get_serial_number(deadline=deadline):
                 return "無法獲取設備序列號"
 
         # 基本檢查
@@ -384,12 +1041,28 @@ class HopperController:
             # auto: 先使用 msb（你遇到的問題就是這個），若未來需要可改為嘗試偵測
             data = list(self.device_serial) + [amount_high, amount_low]
 
+        # 馬達負載調節 (必要時等待冷卻)
+        token, refused = self._admit_payout(self._estimate_payout_coins(amount), deadline)
+        if refused:
+            return refused
+
         # 發送智能退幣指令
-        response = self.send_command(0x35, data)
+        response = self._send_payout(0x35, data, token, deadline)
         result_text = self.analyze_response(response, 0x35)
+        if not response:
+            result_text += "\n退幣指令已送出但未收到確認，請先查詢上一命令狀態 (23H) 再決定是否重試"
 
-        # 立刻查一次狀態並解析
-        status_resp = self.send_command(0x13, [], timeout_override=2)
+        # 立刻查一次狀態並解析 (退幣已送出，期限用盡不再拋出)
+        status_resp = None
+        try:
+            status_resp = self.send_command(0x13, [], timeout_override=2, deadline=deadline)
+            if status_resp and self.decode_status(status_resp)["status_type"] not in PAYOUT_STATUS_TYPES:
+                # 短額退幣在查詢前就已結束：直接以 23H 最終結果結算馬達負載
+                final = self._read_last_payout(deadline)
+                if final:
+                    self._finish_pending_payout(final, token)
+        except HopperTimeoutError as e:
+            logging.warning(f"退幣已送出，但期限內無法完成狀態查詢: {e}")
         if status_resp:
             parsed = self.parse_intelligent_payout_status(status_resp)
             # parse_intelligent_payout_status 應回傳 dict (含 "paid","remain","coins","text")
@@ -422,7 +1095,7 @@ class HopperController:
             if len(response) >= 6:
                 error_code = response[5]
                 return f"設備錯誤: {self.parse_error_code(error_code)} (0x{error_code:02X})"
-        elif status_type == 0x19:  # 清空中
+        elif status_type == EMPTYING_STATUS_TYPE:  # 清空中
             return self.parse_emptying_status(response)
         elif status_type == 0x20:
             return self.parse_multi_payout_status(response)
@@ -434,6 +1107,34 @@ class HopperController:
                 return str(parsed)
         return f"未知狀態類型: 0x{status_type:02X}"
 
+    def decode_status(self, response):
+        """將 13H 回應整理為結構化欄位 (status_type, error_code, paid, remain, coins, text)"""
+        info = {
+            "status_type": None,
+            "error_code": 0,
+            "paid": 0,
+            "remain": 0,
+            "coins": [],
+            "text": self.parse_status_response(response),
+        }
+        if len(response) < 5:
+            return info
+        status_type = response[4]
+        info["status_type"] = status_type
+        if status_type == 0x02 and len(response) >= 6:
+            info["error_code"] = response[5]
+        elif status_type == 0x35:
+            parsed = self.parse_intelligent_payout_status(response)
+            if isinstance(parsed, dict):
+                info["paid"] = parsed["paid"]
+                info["remain"] = parsed["remain"]
+                info["coins"] = parsed["coins"]
+        elif status_type == 0x20 and len(response) >= 13:
+            data = response[4:]
+            info["paid"] = ((data[5] << 8) + data[6]) + ((data[9] << 8) + data[10])
+            info["remain"] = ((data[7] << 8) + data[8]) + ((data[11] << 8) + data[12])
+        return info
+
     # 其餘解析函式 (parse_multi_payout_status, parse_emptying_status, parse_error_code 等)
     def parse_multi_payout_status(self, response):
         if len(response) < 13:
@@ -481,7 +1182,7 @@ class HopperController:
         if error_code & 0x80: errors.append("觸發光電故障")
         return ", ".join(errors) if errors else "未知錯誤"
 
-    def test_communication(self):
+    def test_communication(self, deadline=None):
         logging.info("手動ccTalk通訊測試...")
         test_commands = [
             (0xFE, "Simple Poll"),
@@ -493,10 +1194,11 @@ class HopperController:
             (0xEC, "Read Opto Status"),
             (0xA3, "Test Hopper")
         ]
+        deadline = Deadline.coerce(deadline)
         success_count = 0; device_info = []
         for cmd, name in test_commands:
             logging.info(f"測試 ccTalk 指令: {name} (0x{cmd:02X})")
-            response = self.send_command(cmd, [], 3)
+            response = self.send_command(cmd, [], 3, deadline=deadline)
             if response and len(response) >= 5:
                 if response[0] in (0x01,) and response[2] == self.hopper_address:
                     logging.info(f"✓ {name} 收到回應")
@@ -505,8 +1207,8 @@ class HopperController:
                 logging.warning(f"✗ {name} 失敗或無響應")
         return {'success_count': success_count, 'total': len(test_commands)}
 
-    def test_connection_with_diagnostics(self):
-        res = self.test_communication()
+    def test_connection_with_diagnostics(self, deadline=None):
+        res = self.test_communication(deadline=deadline)
         if isinstance(res, dict) and res.get('success_count', 0) > 0:
             self.connection_tested = True
             logging.info(f"ccTalk 通訊測試: {res['success_count']}/{res['total']} 成功")
@@ -533,16 +1235,191 @@ class HopperController:
                 self.status_thread.join(timeout=2)
             logging.info("背景狀態監控已停止")
 
+    def enable_status_snapshot(self, path='hopper_status.bin'):
+        """讓監控迴圈把每次輪詢結果發佈到記憶體映射檔，其他程序以 read_status_snapshot(path) 讀取"""
+        self.disable_status_snapshot()
+        self.snapshot_writer = StatusSnapshotWriter(path)
+        logging.info(f"狀態快照已啟用: {path}")
+
+    def disable_status_snapshot(self):
+        writer, self.snapshot_writer = self.snapshot_writer, None
+        if writer:
+            # 停用前發佈最後一筆：清除 responding / enabled，讀取端不會把停止的控制器誤認為正常
+            try:
+                writer.publish(self.hopper_address, text="控制器已停止狀態發佈")
+            except (ValueError, OSError) as e:
+                logging.error(f"狀態快照寫入失敗: {e}")
+            writer.close()
+            logging.info("狀態快照已停用")
+
+    def _publish_snapshot(self):
+        writer = self.snapshot_writer
+        if not writer:
+            return
+        state = self.live_state
+        flags = 0
+        if self.is_enabled: flags |= SNAPSHOT_FLAG_ENABLED
+        if state.get("opto_empty"): flags |= SNAPSHOT_FLAG_OPTO_EMPTY
+        if state.get("opto_full"): flags |= SNAPSHOT_FLAG_OPTO_FULL
+        if state.get("opto_status") is not None: flags |= SNAPSHOT_FLAG_OPTO_VALID
+        if state.get("responding"): flags |= SNAPSHOT_FLAG_RESPONDING
+        if state.get("status_type") in PAYOUT_STATUS_TYPES: flags |= SNAPSHOT_FLAG_PAYOUT_ACTIVE
+        if state.get("status_type") == EMPTYING_STATUS_TYPE: flags |= SNAPSHOT_FLAG_EMPTYING
+        try:
+            writer.publish(
+                self.hopper_address,
+                status_type=state.get("status_type") or 0,
+                error_code=state.get("error_code", 0),
+                opto_status=state.get("opto_status") or 0,
+                flags=flags,
+                paid=state.get("paid", 0),
+                remain=state.get("remain", 0),
+                text=state.get("text", ""),
+            )
+        except (ValueError, OSError) as e:
+            logging.error(f"狀態快照寫入失敗: {e}")
+
+    # ---------- 事件訂閱 ----------
+    def subscribe(self, callback, event_types=None):
+        """
+        訂閱狀態變化事件，callback(HopperEvent) 在事件派送執行緒上呼叫 (不佔用串列埠)。
+        event_types: 只接收的 HopperEventType 集合，None 表示全部。
+        回傳訂閱編號，供 unsubscribe 使用。
+        """
+        types = frozenset(event_types) if event_types is not None else None
+        with self._subscribers_lock:
+            sub_id = self._next_subscription_id
+            self._next_subscription_id += 1
+            self._subscribers[sub_id] = (callback, types)
+            if not self._event_thread or not self._event_thread.is_alive():
+                self._event_thread = threading.Thread(target=self._event_dispatch_loop, daemon=True)
+                self._event_thread.start()
+        return sub_id
+
+    def unsubscribe(self, sub_id):
+        with self._subscribers_lock:
+            return self._subscribers.pop(sub_id, None) is not None
+
+    async def events(self, event_types=None):
+        """
+        非同步迭代形式：
+            async for event in controller.events({HopperEventType.PAYOUT_DONE}): ...
+        結束迭代 (break / 取消) 時自動取消訂閱。
+        """
+        loop = asyncio.get_running_loop()
+        pending = asyncio.Queue()
+        sub_id = self.subscribe(lambda ev: loop.call_soon_threadsafe(pending.put_nowait, ev), event_types)
+        try:
+            while True:
+                yield await pending.get()
+        finally:
+            self.unsubscribe(sub_id)
+
+    def _emit_events(self, events):
+        """收件者在發出當下決定：沒有訂閱者就丟棄，之後才訂閱的人不會收到過去的事件"""
+        for event in events:
+            logging.info(f"[事件] {event.type.value}: {event.data}")
+            with self._subscribers_lock:
+                targets = [
+                    (sub_id, callback) for sub_id, (callback, types) in self._subscribers.items()
+                    if types is None or event.type in types
+                ]
+            if targets:
+                self._event_queue.put((event, targets))
+
+    def _event_dispatch_loop(self):
+        while True:
+            event, targets = self._event_queue.get()
+            for sub_id, callback in targets:
+                if sub_id not in self._subscribers:
+                    # 排隊期間已取消訂閱
+                    continue
+                try:
+                    callback(event)
+                except Exception as e:
+                    logging.error(f"事件回呼錯誤 ({event.type.value}): {e}")
+
+    def _diff_live_state(self, old, new):
+        """比較前後兩次輪詢的 live_state，只在狀態實際改變時產生事件"""
+        now = time.time()
+        events = []
+
+        def add(event_type, **data):
+            events.append(HopperEvent(event_type, now, data))
+
+        if not new.get("responding"):
+            if old.get("responding") is not False:
+                add(HopperEventType.DEVICE_LOST)
+            return events
+        if old.get("responding") is False:
+            add(HopperEventType.DEVICE_RESTORED)
+
+        old_type = old.get("status_type")
+        new_type = new.get("status_type")
+        if old_type != new_type:
+            add(HopperEventType.STATUS_CHANGED, previous=old_type, status_type=new_type, text=new.get("text"))
+
+        was_paying = old_type in PAYOUT_STATUS_TYPES
+        is_paying = new_type in PAYOUT_STATUS_TYPES
+        if is_paying and not was_paying:
+            add(HopperEventType.PAYOUT_STARTED, status_type=new_type, paid=new.get("paid", 0), remain=new.get("remain", 0))
+        elif is_paying and (old.get("paid"), old.get("remain")) != (new.get("paid"), new.get("remain")):
+            add(HopperEventType.PAYOUT_PROGRESS, status_type=new_type, paid=new.get("paid", 0), remain=new.get("remain", 0))
+        # PAYOUT_DONE / COIN_SHORTAGE 由 _finish_pending_payout 在結算每筆退幣時發出，
+        # 輪詢間隔內就完成的短額退幣也不會漏掉
+
+        if new_type == 0x02 and (old_type != 0x02 or old.get("error_code") != new.get("error_code")):
+            add(HopperEventType.DEVICE_ERROR, error_code=new.get("error_code", 0), text=new.get("text"))
+        elif old_type == 0x02 and new_type != 0x02:
+            add(HopperEventType.ERROR_CLEARED, previous_error_code=old.get("error_code", 0))
+
+        if "opto_status" in new:
+            if new["opto_empty"] and not old.get("opto_empty", False):
+                add(HopperEventType.HOPPER_EMPTY, opto_status=new["opto_status"])
+            elif not new["opto_empty"] and old.get("opto_empty", False):
+                add(HopperEventType.HOPPER_REFILLED, opto_status=new["opto_status"])
+        return events
+
+    def _poll_live_state(self):
+        """監控迴圈的一次輪詢：更新 self.live_state、發出狀態變化事件，並回傳是否有回應"""
+        old = self.live_state
+        state = dict(old)
+        state.pop("last_payout", None)
+        status_response = self.send_command(0x13, [], 2)
+        if status_response:
+            state.update(self.decode_status(status_response))
+            state["responding"] = True
+            if state["status_type"] != 0x35 and (old.get("status_type") == 0x35 or self._has_pending_payout(0x35)):
+                # 智能退幣已結束 (含輪詢間隔內就完成的短額退幣)：用 23H 讀取最終退幣結果 (已付 / 未付)
+                last_payout = self._read_last_payout()
+                if last_payout:
+                    state["last_payout"] = last_payout
+            if self.snapshot_writer or self._subscribers or self.motor_governor.is_locked_out():
+                # 光電狀態僅在有人讀取快照、訂閱事件或等待補幣解除鎖定時才額外輪詢，避免增加匯流排流量
+                opto_response = self.send_command(0xEC, [], 1)
+                if opto_response and len(opto_response) >= 5:
+                    opto_status = opto_response[4]
+                    state["opto_status"] = opto_status
+                    state["opto_empty"] = (opto_status & 0x01) != 0
+                    state["opto_full"] = (opto_status & 0x02) != 0
+        else:
+            state["responding"] = False
+        self.live_state = state
+        self._publish_snapshot()
+        events = self._diff_live_state(old, state)
+        self._update_motor_governor(old, state, events)
+        self._emit_events(events)
+        return status_response is not None
+
     def _status_monitoring_loop(self):
         logging.info("開始背景狀態監控...")
         while self.is_running:
             try:
-                status_response = self.send_command(0x13, [], 2)
-                if status_response:
-                    info = self.parse_status_response(status_response)
-                    logging.info(f"[狀態監控] {info}")
+                if self._poll_live_state():
+                    logging.info(f"[狀態監控] {self.live_state['text']}")
                 else:
                     logging.warning("[狀態監控] 無響應")
+                self._recalibrate_if_needed()
                 for _ in range(30):
                     if not self.is_running: break
                     time.sleep(0.1)
@@ -551,12 +1428,13 @@ class HopperController:
                 time.sleep(1)
         logging.info("背景狀態監控循環已結束")
 
-    def check_hopper_status(self):
+    def check_hopper_status(self, deadline=None):
+        deadline = Deadline.coerce(deadline)
         try:
-            response = self.send_command(0x13, [], 2)
+            response = self.send_command(0x13, [], 2, deadline=deadline)
             if response:
                 status_info = self.parse_status_response(response)
-                opto_response = self.send_command(0xEC, [], 1)
+                opto_response = self.send_command(0xEC, [], 1, deadline=deadline)
                 if opto_response and len(opto_response) >= 5:
                     opto_status = opto_response[4]
                     empty = (opto_status & 0x01) != 0
@@ -565,11 +1443,13 @@ class HopperController:
                 return status_info
             else:
                 return "設備無響應"
+        except HopperTimeoutError:
+            raise
         except Exception as e:
             logging.error(f"檢查狀態時發生錯誤: {e}")
             return f"狀態檢查錯誤: {e}"
 
-    def multi_path_payout(self, path_number, coin_count):
+    def multi_path_payout(self, path_number, coin_count, deadline=None):
         if path_number < 1 or path_number > 6:
             return "航道編號應為1-6"
         if not self.device_serial:
@@ -580,15 +1460,166 @@ class HopperController:
                 data.extend([0x00, coin_count])
             else:
                 data.extend([0x00, 0x00])
-        response = self.send_command(0x20, data)
-        return self.analyze_response(response, 0x20)
+        deadline = Deadline.coerce(deadline)
+        token, refused = self._admit_payout(coin_count, deadline)
+        if refused:
+            return refused
+        response = self._send_payout(0x20, data, token, deadline)
+        result_text = self.analyze_response(response, 0x20)
+        if not response:
+            result_text += "\n退幣指令已送出但未收到確認，請先確認設備狀態再決定是否重試"
+        return result_text
 
-    def read_opto_status(self):
-        response = self.send_command(0xEC)
+    def _admit_payout(self, estimated_coins, deadline):
+        """
+        通過馬達負載調節才可退幣，回傳 (token, 拒絕訊息)。
+        連續缺幣鎖定、或未給 deadline 而需冷卻太久時拒絕。
+        """
+        governor = self.motor_governor
+        if governor.is_locked_out():
+            logging.error(f"連續 {governor.consecutive_failures} 次退幣未完成，判定機器缺幣，暫停退幣以免過熱")
+            return None, "機器缺幣：連續退幣未完成，請補充硬幣後再試"
+        run_s = min(governor.estimate_run_seconds(estimated_coins), governor.thermal_capacity_s)
+        token = governor.acquire(run_s, deadline)
+        if token is None:
+            wait = governor.wait_time(run_s)
+            if wait == float('inf'):
+                return None, "馬達過熱保護：cooling_rate 為 0，熱量無法下降，請檢查調節器設定"
+            return None, f"馬達過熱保護：需冷卻約 {wait:.0f} 秒後再退幣"
+        return token, None
+
+    def _send_payout(self, command, data, token, deadline):
+        """送出退幣指令並依回覆處理預扣：ACK 列入待結算，NACK 撤銷，無回應則保留預估值"""
+        governor = self.motor_governor
+        try:
+            response = self.send_command(command, data, deadline=deadline)
+        except HopperTimeoutError:
+            governor.settle(token)
+            raise
+        if response and len(response) >= 4 and response[3] == 0x00:
+            with self._pending_payouts_lock:
+                self._pending_payouts.append({"token": token, "command": command, "started": time.monotonic()})
+        elif response and len(response) >= 4 and response[3] == 0x05:
+            governor.settle(token, 0)
+        else:
+            governor.settle(token)
+        return response
+
+    def _has_pending_payout(self, command):
+        with self._pending_payouts_lock:
+            return any(entry["command"] == command for entry in self._pending_payouts)
+
+    def _estimate_payout_coins(self, amount):
+        """智能退幣的硬幣枚數估計：優先用實際觀測的平均面額，否則用 payout_coin_value_hint"""
+        value = self.observed_value_per_coin or self.payout_coin_value_hint
+        return max(1, int(-(-amount // value)))
+
+    def _expire_pending_payouts(self):
+        """
+        逾時仍無對應結果的退幣：保留預估熱量、不計入缺幣，
+        並發出 confirmed=False 的 PAYOUT_DONE (實際已付 / 未付不明)。
+        """
+        now = time.monotonic()
+        expired = []
+        with self._pending_payouts_lock:
+            while self._pending_payouts and now - self._pending_payouts[0]["started"] > self.pending_payout_timeout:
+                expired.append(self._pending_payouts.popleft())
+        for entry in expired:
+            logging.warning(f"退幣 0x{entry['command']:02X} 無法對應到最終狀態，以預估值結算馬達負載")
+            self.motor_governor.settle(entry["token"])
+            self._emit_events([HopperEvent(HopperEventType.PAYOUT_DONE, time.time(), {
+                "status_type": entry["command"], "paid": None, "remain": None, "coins": [], "confirmed": False,
+            })])
+
+    def _pending_payout_token(self, command, newest):
+        """取得指定指令最早 (newest=False) 或最新 (newest=True) 一筆待結算退幣的 token"""
+        with self._pending_payouts_lock:
+            entries = [entry for entry in self._pending_payouts if entry["command"] == command]
+        if not entries:
+            return None
+        return entries[-1 if newest else 0]["token"]
+
+    def _read_last_payout(self, deadline=None):
+        """以 23H 讀取最近一次智能退幣的最終結果 {"paid", "remain", "coins"}，取不到回傳 None"""
+        last_resp = self.send_command(0x23, [], 1, deadline=deadline)
+        if last_resp and len(last_resp) >= 5 and last_resp[3] == 0x00:
+            parsed = self.parse_intelligent_payout_status(last_resp)
+            if isinstance(parsed, dict):
+                return {"paid": parsed["paid"], "remain": parsed["remain"], "coins": parsed["coins"]}
+        return None
+
+    def _finish_pending_payout(self, final, token):
+        """
+        以 final (23H / 13H 對應到這筆退幣的結果) 結算 token 那筆已結束的退幣：
+        以硬幣數估算實際運轉時間；缺幣時馬達會空轉找幣，改取觀測到的經過時間。
+        """
+        with self._pending_payouts_lock:
+            entry = next((e for e in self._pending_payouts if e["token"] == token), None)
+            if entry is None:
+                return
+            self._pending_payouts.remove(entry)
+        governor = self.motor_governor
+        coins = sum(final.get("coins") or [])
+        if entry["command"] == 0x35 and coins and final.get("paid"):
+            value = final["paid"] / coins
+            previous = self.observed_value_per_coin
+            self.observed_value_per_coin = value if previous is None else previous * 0.7 + value * 0.3
+        if not coins and entry["command"] == 0x20:
+            # 多航道退幣的 paid 即為硬幣枚數
+            coins = final.get("paid", 0)
+        elapsed = time.monotonic() - entry["started"]
+        shortage = final.get("remain", 0) > 0
+        run_s = governor.estimate_run_seconds(coins) if coins else elapsed
+        governor.settle(entry["token"], max(run_s, elapsed) if shortage else run_s)
+        if shortage:
+            governor.record_failure()
+        else:
+            governor.record_success()
+        event_type = HopperEventType.COIN_SHORTAGE if shortage else HopperEventType.PAYOUT_DONE
+        self._emit_events([HopperEvent(event_type, time.time(), {
+            "status_type": entry["command"],
+            "paid": final.get("paid", 0),
+            "remain": final.get("remain", 0),
+            "coins": final.get("coins") or [],
+        })])
+
+    def _update_motor_governor(self, old, new, events):
+        """依監控觀測修正馬達負載：結算已結束的退幣、計入清空時間、補幣後解除缺幣鎖定"""
+        governor = self.motor_governor
+        new_type = new.get("status_type") if new.get("responding") else None
+        if new_type == EMPTYING_STATUS_TYPE and self._emptying_observed_since is None:
+            self._emptying_observed_since = time.monotonic()
+        elif new_type != EMPTYING_STATUS_TYPE and self._emptying_observed_since is not None:
+            governor.add_run(time.monotonic() - self._emptying_observed_since)
+            self._emptying_observed_since = None
+        if new.get("responding") and new_type not in PAYOUT_STATUS_TYPES:
+            # 只結算結果實際描述的那一筆：23H 描述最近一次智能退幣；
+            # 否則上一輪輪詢看到進行中的退幣，即為同指令最早送出的那筆
+            old_type = old.get("status_type")
+            if new.get("last_payout"):
+                token = self._pending_payout_token(0x35, newest=True)
+                if token is not None:
+                    self._finish_pending_payout(new["last_payout"], token)
+            elif old_type in PAYOUT_STATUS_TYPES:
+                token = self._pending_payout_token(old_type, newest=False)
+                if token is not None:
+                    self._finish_pending_payout(
+                        {"paid": old.get("paid", 0), "remain": old.get("remain", 0), "coins": old.get("coins", [])}, token)
+            self._expire_pending_payouts()
+        for event in events:
+            if event.type == HopperEventType.HOPPER_REFILLED:
+                governor.reset_failures()
+
+    def motor_status(self):
+        """馬達負載報告 (熱量、餘裕、連續缺幣次數)"""
+        return self.motor_governor.report()
+
+    def read_opto_status(self, deadline=None):
+        response = self.send_command(0xEC, deadline=deadline)
         return self.analyze_response(response, 0xEC)
 
-    def test_hopper(self):
-        response = self.send_command(0xA3)
+    def test_hopper(self, deadline=None):
+        response = self.send_command(0xA3, deadline=deadline)
         return self.analyze_response(response, 0xA3)
 
     def device_info(self):
@@ -598,11 +1629,20 @@ class HopperController:
             info += f"序列號: {self.device_serial.hex('-').upper()}\n"
         else:
             info += "序列號: 未獲取\n"
-        info += f"通訊測試: {'通過' if self.connection_tested else '未通過'}"
+        info += f"通訊測試: {'通過' if self.connection_tested else '未通過'}\n"
+        if self.link_timing.calibrated_at and not self.link_timing.stale:
+            info += f"通訊時序: 已校準 ({time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.link_timing.calibrated_at))})\n"
+        else:
+            info += "通訊時序: 未校準 (使用預設逾時)\n"
+        motor = self.motor_status()
+        info += f"馬達熱量餘裕: {motor['headroom_s']:.1f}/{motor['capacity_s']:.0f} 秒 (負載 {motor['load']:.0%})"
+        if motor["locked_out"]:
+            info += f" | 連續缺幣 {motor['consecutive_failures']} 次，已暫停退幣"
         return info
 
     def disconnect(self):
         self.stop_status_monitoring()
+        self.disable_status_snapshot()
         if self.is_enabled:
             try: self.disable_device()
             except: pass
@@ -613,6 +1653,7 @@ class HopperController:
 
 # ---------- main() 保留原本互動式介面並加入 STOP/CANCEL 選項 ----------
 def main():
+    setup_logging()
     controller = HopperController()
     print("=== H6 Hopper 控制程式 (含修正與安全機制) ===")
     ports = controller.find_serial_ports()
@@ -651,6 +1692,7 @@ def main():
             print("13. 取消 (CANCEL)")
             print("14. 退出")
             print("15. 查詢上一命令狀態 (23H)")
+            print("16. 已補幣，解除缺幣鎖定")
 
             status = "✓ 通訊正常" if controller.connection_tested else "✗ 通訊異常"
             status += " | 已啟用" if controller.is_enabled else " | 未啟用"
@@ -730,6 +1772,10 @@ def main():
                 result = controller.request_last_command_status()
                 print(f"上一命令狀態 (23H):\n{result}")
 
+            elif choice == "16":
+                controller.motor_governor.reset_failures()
+                print("缺幣鎖定已解除")
+
             else:
                 print("選擇無效")
 
@@ -751,7 +1797,11 @@ if __name__ == "__main__":
 # In[8]:
 
 
-get_ipython().system('jupyter nbconvert --to script FC0917H6TEST.ipynb')
+try:
+    get_ipython().system('jupyter nbconvert --to script FC0917H6TEST.ipynb')
+except NameError:
+    # 非 Jupyter 環境 (直接執行或被其他程序 import) 時略過
+    pass
 
 
 # In[ ]: